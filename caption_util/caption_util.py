@@ -1,6 +1,10 @@
 #!/usr/bin/env python3
 import argparse
+import heapq
+import json
 import sys
+from collections.abc import Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import shutil
 from itertools import count
@@ -17,10 +21,10 @@ def normalize_extension(ext: str | None, default: str | None = None) -> str | No
     return ext
 
 
-def combine_captions(input_dir: Path, ext: str, output_file: Path | None) -> int:
+def list_caption_files(input_dir: Path, ext: str) -> list[Path] | None:
     if not input_dir.exists() or not input_dir.is_dir():
         print(f"Error: input directory does not exist or is not a directory: {input_dir}", file=sys.stderr)
-        return 1
+        return None
 
     files = sorted(
         p for p in input_dir.iterdir()
@@ -32,6 +36,35 @@ def combine_captions(input_dir: Path, ext: str, output_file: Path | None) -> int
             f"Error: no files with extension '{ext}' were found in {input_dir}",
             file=sys.stderr,
         )
+        return None
+
+    return files
+
+
+def read_caption_entries(files: list[Path]) -> Iterator[tuple[str, str]]:
+    for f in files:
+        try:
+            content = f.read_text(encoding="utf-8")
+        except Exception as e:
+            print(f"Warning: failed to read '{f}': {e}", file=sys.stderr)
+            continue
+
+        # Flatten to a single line; strip trailing whitespace
+        prompt = content.strip().replace("\n", " ")
+        yield f.name, prompt
+
+
+def write_combined_entries(entries: Iterable[tuple[str, str]], out_stream) -> None:
+    for idx, (name, prompt) in enumerate(entries):
+        if idx > 0:
+            out_stream.write("\n")  # blank line between entries
+
+        out_stream.write(f"{name}: {prompt}\n")
+
+
+def combine_captions(input_dir: Path, ext: str, output_file: Path | None) -> int:
+    files = list_caption_files(input_dir, ext)
+    if files is None:
         return 1
 
     out_stream = sys.stdout
@@ -42,20 +75,8 @@ def combine_captions(input_dir: Path, ext: str, output_file: Path | None) -> int
             fh = output_file.open("w", encoding="utf-8")
             out_stream = fh
 
-        for idx, f in enumerate(files):
-            try:
-                content = f.read_text(encoding="utf-8")
-            except Exception as e:
-                print(f"Warning: failed to read '{f}': {e}", file=sys.stderr)
-                continue
-
-            # Flatten to a single line; strip trailing whitespace
-            prompt = content.strip().replace("\n", " ")
-
-            if idx > 0:
-                out_stream.write("\n")  # blank line between entries
-
-            out_stream.write(f"{f.name}: {prompt}\n")
+        # stream one caption at a time instead of holding the whole set
+        write_combined_entries(read_caption_entries(files), out_stream)
     finally:
         if fh is not None:
             fh.close()
@@ -63,6 +84,148 @@ def combine_captions(input_dir: Path, ext: str, output_file: Path | None) -> int
     return 0
 
 
+def entry_sizes(entries: list[tuple[str, str]], tokenizer) -> list[int]:
+    """
+    Size of each combined entry: tokenizer token count if a tokenizer is given,
+    otherwise character count.
+    """
+    texts = [f"{name}: {prompt}\n" for name, prompt in entries]
+    if tokenizer is None:
+        return [len(t) for t in texts]
+    return [len(ids) for ids in tokenizer(texts, add_special_tokens=False)["input_ids"]]
+
+
+def separator_size(tokenizer) -> int:
+    """Size of the blank line written between entries, in the same unit as entry_sizes."""
+    if tokenizer is None:
+        return 1
+    return len(tokenizer("\n", add_special_tokens=False)["input_ids"])
+
+
+def shard_load(sizes: list[int], members: list[int], sep: int) -> int:
+    return sum(sizes[i] for i in members) + sep * max(len(members) - 1, 0)
+
+
+def balance_shards(sizes: list[int], shards: int) -> list[list[int]]:
+    """
+    Assign entry indices to shards, largest entry first onto the lightest shard.
+    Each shard keeps its entries in the original order.
+    """
+    heap = [(0, i) for i in range(shards)]
+    assigned: list[list[int]] = [[] for _ in range(shards)]
+    for idx in sorted(range(len(sizes)), key=lambda i: sizes[i], reverse=True):
+        load, shard = heapq.heappop(heap)
+        assigned[shard].append(idx)
+        heapq.heappush(heap, (load + sizes[idx], shard))
+    return [sorted(a) for a in assigned]
+
+
+def shard_path(output_file: Path, idx: int) -> Path:
+    return output_file.with_name(f"{output_file.stem}.{idx:03d}{output_file.suffix}")
+
+
+def index_path(output_file: Path) -> Path:
+    return output_file.with_name(f"{output_file.stem}.index.json")
+
+
+def combine_captions_sharded(
+    input_dir: Path,
+    ext: str,
+    output_file: Path,
+    shards: int | None,
+    max_shard_size: int | None,
+    tokenizer_name: str | None,
+) -> int:
+    """
+    Combine captions into several balanced shard files plus a JSON shard index.
+
+    Shards are balanced by character count, or by token count when a tokenizer
+    is given. With --max-shard-size the shard count grows until every shard
+    fits the budget.
+    """
+    files = list_caption_files(input_dir, ext)
+    if files is None:
+        return 1
+
+    entries = list(read_caption_entries(files))
+    if not entries:
+        print("Error: no caption files could be read.", file=sys.stderr)
+        return 1
+
+    tokenizer = None
+    if tokenizer_name is not None:
+        try:
+            from transformers import AutoTokenizer
+        except ImportError:
+            print("Error: --tokenizer requires the 'transformers' package.", file=sys.stderr)
+            return 1
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_name, trust_remote_code=True)
+
+    sizes = entry_sizes(entries, tokenizer)
+    sep = separator_size(tokenizer)
+    unit = "tokens" if tokenizer is not None else "chars"
+    total = shard_load(sizes, list(range(len(entries))), sep)
+
+    if max_shard_size is not None:
+        too_big = [entries[i][0] for i, n in enumerate(sizes) if n > max_shard_size]
+        if too_big:
+            print(
+                f"Error: {len(too_big)} entries exceed the shard budget of {max_shard_size} {unit} "
+                f"on their own (e.g. '{too_big[0]}').",
+                file=sys.stderr,
+            )
+            return 1
+
+    if shards is not None and shards > len(entries):
+        print(
+            f"Warning: only {len(entries)} entries; writing {len(entries)} shards instead of {shards}.",
+            file=sys.stderr,
+        )
+
+    n_shards = shards or max(1, -(-total // max_shard_size))
+    n_shards = min(n_shards, len(entries))
+    while True:
+        # each entry carries one separator; a shard with n entries has n - 1
+        assigned = balance_shards([n + sep for n in sizes], n_shards)
+        loads = [shard_load(sizes, a, sep) for a in assigned]
+        if max_shard_size is None or max(loads) <= max_shard_size:
+            break
+        if shards is not None:
+            print(
+                f"Error: {shards} shards cannot hold {total} {unit} within {max_shard_size} {unit} each; "
+                f"raise --shards or --max-shard-size.",
+                file=sys.stderr,
+            )
+            return 1
+        n_shards += 1
+
+    output_file.parent.mkdir(parents=True, exist_ok=True)
+    index = {
+        "source_dir": str(input_dir),
+        "extension": ext,
+        "unit": unit,
+        "tokenizer": tokenizer_name,
+        "max_shard_size": max_shard_size,
+        "shards": [],
+    }
+    for idx, (a, load) in enumerate(zip(assigned, loads)):
+        path = shard_path(output_file, idx)
+        with path.open("w", encoding="utf-8") as fh:
+            write_combined_entries([entries[i] for i in a], fh)
+        index["shards"].append({
+            "file": path.name,
+            "entries": len(a),
+            "size": load,
+            "captions": [entries[i][0] for i in a],
+        })
+        print(f"Wrote {path.name}: {len(a)} entries, {load} {unit}", file=sys.stderr)
+
+    idx_path = index_path(output_file)
+    idx_path.write_text(json.dumps(index, indent=2) + "\n", encoding="utf-8")
+    print(f"Wrote shard index: {idx_path}", file=sys.stderr)
+    return 0
+
+
 def move_to_backup(path: Path, backup_dir: Path) -> None:
     backup_dir.mkdir(parents=True, exist_ok=True)
     target = backup_dir / path.name
@@ -165,6 +328,37 @@ def split_captions(
 
     return 0
 
+def split_shards(
+    index_file: Path,
+    output_dir: Path,
+    ext: str | None,
+    workers: int | None,
+) -> int:
+    """
+    Split every shard listed in a shard index concurrently.
+
+    Each caption appears in exactly one shard, so shards can be processed in
+    any order. A failed or missing shard is reported but doesn't stop the rest.
+    """
+    try:
+        index = json.loads(index_file.read_text(encoding="utf-8"))
+        shard_files = [index_file.parent / s["file"] for s in index["shards"]]
+    except Exception as e:
+        print(f"Error: failed to read shard index '{index_file}': {e}", file=sys.stderr)
+        return 1
+
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        results = list(ex.map(lambda f: split_captions(str(f), output_dir, ext), shard_files))
+
+    failed = [f.name for f, rc in zip(shard_files, results) if rc != 0]
+    if failed:
+        print(f"Error: {len(failed)} of {len(shard_files)} shard(s) failed: {', '.join(failed)}", file=sys.stderr)
+        return 1
+
+    return 0
+
+
 def rename_files(
     input_dir: Path,
     input_ext: str,
@@ -218,7 +412,7 @@ def build_arg_parser() -> argparse.ArgumentParser:
     # combine subcommand
     p_combine = subparsers.add_parser(
         "combine",
-        help="Combine individual caption files into a single stream/file.",
+        help="Combine individual caption files into a single stream/file, or into balanced shards.",
     )
     p_combine.add_argument(
         "--input-dir",
@@ -242,6 +436,28 @@ def build_arg_parser() -> argparse.ArgumentParser:
         default=".caption",
         help="File extension to process (default: .caption).",
     )
+    p_combine.add_argument(
+        "--shards",
+        "-n",
+        type=int,
+        default=None,
+        help="Write this many balanced shard files (<output>.000<ext>, ...) plus "
+             "<output>.index.json instead of one combined file. Requires --output-file.",
+    )
+    p_combine.add_argument(
+        "--max-shard-size",
+        type=int,
+        default=None,
+        help="Per-shard budget in characters (or tokens with --tokenizer). "
+             "Without --shards, as many shards as needed are written.",
+    )
+    p_combine.add_argument(
+        "--tokenizer",
+        type=str,
+        default=None,
+        help="Balance shards by token count using this Hugging Face tokenizer "
+             "(requires transformers; default: balance by character count).",
+    )
 
     # split subcommand
     p_split = subparsers.add_parser(
@@ -253,7 +469,8 @@ def build_arg_parser() -> argparse.ArgumentParser:
         "-i",
         type=str,
         required=True,
-        help="Combined caption file to read (use '-' to read from stdin).",
+        help="Combined caption file to read (use '-' to read from stdin), "
+             "or a shard index (*.index.json) to split all of its shards.",
     )
     p_split.add_argument(
         "--output-dir",
@@ -270,6 +487,12 @@ def build_arg_parser() -> argparse.ArgumentParser:
         help="Extension for output files (e.g. '.caption'). "
              "If omitted, filenames from the combined file are used as-is.",
     )
+    p_split.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Shards split concurrently when reading a shard index (default: Python's thread pool default).",
+    )
 
     # rename subcommand
     p_rename = subparsers.add_parser(
@@ -321,11 +544,28 @@ def main(argv: list[str] | None = None) -> int:
                 out_path = base_dir / out_path
             output_file = out_path
 
+        if args.tokenizer is not None and args.shards is None and args.max_shard_size is None:
+            print("Error: --tokenizer requires --shards or --max-shard-size.", file=sys.stderr)
+            return 1
+        if args.shards is not None or args.max_shard_size is not None:
+            if output_file is None:
+                print("Error: sharded combine requires --output-file.", file=sys.stderr)
+                return 1
+            if (args.shards is not None and args.shards < 1) or \
+                    (args.max_shard_size is not None and args.max_shard_size < 1):
+                print("Error: --shards and --max-shard-size must be positive.", file=sys.stderr)
+                return 1
+            return combine_captions_sharded(
+                input_dir, ext, output_file, args.shards, args.max_shard_size, args.tokenizer,
+            )
+
         return combine_captions(input_dir, ext, output_file)
 
     elif args.command == "split":
         output_dir = Path(args.output_dir) if args.output_dir is not None else Path.cwd()
         ext = normalize_extension(args.extension, default=None)
+        if args.input_file.endswith(".index.json"):
+            return split_shards(Path(args.input_file), output_dir, ext, args.workers)
         return split_captions(args.input_file, output_dir, ext)
 
     elif args.command == "rename":
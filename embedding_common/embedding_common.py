@@ -0,0 +1,270 @@
+import atexit
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import torch
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+PRECISIONS = {
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+    "int8": torch.int8,
+}
+
+# vocab rows processed at a time; the scan holds the store plus one block
+DEFAULT_BLOCK_SIZE = 8192
+
+
+class PhaseProfiler:
+    """Wall time, CPU time and peak RSS per named phase; a no-op unless enabled."""
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = {}
+        self.events = []
+        self.t0 = time.perf_counter()
+        self._open = []  # peak RSS seen by each phase currently running, innermost last
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        # registered on entry so the summary lists phases in the order they start
+        p = self.phases.setdefault(name, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_rss_mib": None})
+
+        # the kernel high-water mark is reset at phase entry, so fold what it has
+        # seen so far into the enclosing phases first
+        self._observe_peak(peak_rss_mib())
+        reset_peak_rss()
+        self._open.append(None)
+
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall0, time.process_time() - cpu0
+            self._observe_peak(peak_rss_mib())
+            peak = self._open.pop()
+            self._observe_peak(peak)
+            p["calls"] += 1
+            p["wall_s"] += wall
+            p["cpu_s"] += cpu
+            if peak is not None:
+                p["peak_rss_mib"] = max(p["peak_rss_mib"] or 0.0, peak)
+            # chrome://tracing "complete" event, microseconds since profiler start
+            self.events.append({"name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                                "ts": (wall0 - self.t0) * 1e6, "dur": wall * 1e6})
+
+    def _observe_peak(self, rss):
+        if rss is None:
+            return
+        self._open = [rss if p is None else max(p, rss) for p in self._open]
+
+    def summary(self, file=sys.stderr):
+        print(f"{'phase':<24} {'calls':>7} {'wall s':>10} {'cpu s':>10} {'peak RSS MiB':>13}", file=file)
+        for name, p in self.phases.items():
+            rss = f"{p['peak_rss_mib']:.1f}" if p["peak_rss_mib"] is not None else "n/a"
+            print(f"{name:<24} {p['calls']:>7} {p['wall_s']:>10.3f} {p['cpu_s']:>10.3f} {rss:>13}", file=file)
+
+    def write_json(self, path):
+        trace = {"phases": self.phases, "traceEvents": self.events}
+        Path(path).write_text(json.dumps(trace, indent=2), encoding="utf-8")
+
+
+def reset_peak_rss():
+    # Linux only: writing 5 to clear_refs resets VmHWM to the current RSS
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_mib():
+    # VmHWM since the last reset on Linux; elsewhere the process-lifetime ru_maxrss
+    # (KiB on Linux, bytes on macOS)
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+PROFILER = PhaseProfiler()
+
+
+def normalize_embeddings(E, precision, block_size=DEFAULT_BLOCK_SIZE):
+    # row-normalize E into a reduced `precision`; int8 rows carry a float32 scale each
+    V, D = E.shape
+    En = torch.empty((V, D), dtype=PRECISIONS[precision])
+    scales = torch.empty(V, dtype=torch.float32) if precision == "int8" else None
+
+    for start in range(0, V, block_size):
+        end = min(start + block_size, V)
+        blk = E[start:end].float()
+        blk = blk / blk.norm(dim=1, keepdim=True).clamp_min(1e-8)
+        if scales is not None:
+            s = blk.abs().amax(dim=1, keepdim=True).clamp_min(1e-8) / 127.0
+            En[start:end] = torch.round(blk / s).to(torch.int8)
+            scales[start:end] = s.squeeze(1)
+        else:
+            En[start:end] = blk.to(En.dtype)
+
+    return En, scales
+
+
+def spill_rows(E):
+    # copy E to an unlinked temp file and map it back, so exact rows for
+    # re-ranking are paged in on demand instead of staying resident
+    fd, path = tempfile.mkstemp(prefix="embeddings_", suffix=".bin")
+    try:
+        os.ftruncate(fd, E.numel() * E.element_size())
+        os.close(fd)
+        out = torch.from_file(path, shared=True, size=E.numel(), dtype=E.dtype)
+        out.copy_(E.reshape(-1))
+        del out
+        return torch.from_file(path, shared=False, size=E.numel(), dtype=E.dtype).view(E.shape)
+    finally:
+        try:
+            os.unlink(path)
+        except OSError:  # Windows cannot unlink a mapped file; remove it on exit
+            atexit.register(lambda: os.path.exists(path) and os.unlink(path))
+
+
+def quantize_rows(x):
+    # symmetric per-row int8 quantization; returns (int8 rows, float32 row scales)
+    s = x.abs().amax(dim=1, keepdim=True).clamp_min(1e-8) / 127.0
+    return torch.round(x / s).to(torch.int8), s.squeeze(1)
+
+
+def int8_matmul(a, b):
+    # int8 x int8 -> int32; falls back to bf16, which holds int8 values exactly,
+    # on torch builds without a CPU torch._int_mm
+    try:
+        return torch._int_mm(a, b)
+    except (AttributeError, RuntimeError, NotImplementedError):
+        return (a.to(torch.bfloat16) @ b.to(torch.bfloat16)).float()
+
+
+class EmbeddingStore:
+    """
+    Row-normalized vocab embeddings in one of PRECISIONS, scanned block by block.
+
+    fp32 keeps a reference to E and normalizes each block on the fly. Reduced
+    precisions build their own smaller copy, so the caller can drop E once the
+    store is built. Exact rows for re-ranking are then kept only when asked for,
+    spilled to disk and paged back in on demand.
+    """
+
+    def __init__(self, E, precision="fp32", block_size=DEFAULT_BLOCK_SIZE, keep_exact=False):
+        self.precision = precision
+        self.V, self.D = E.shape
+        self.E = self.En = self.scales = self.exact = None
+        if precision == "fp32":
+            self.E = self.exact = E
+            return
+        self.En, self.scales = normalize_embeddings(E, precision, block_size=block_size)
+        if keep_exact:
+            self.exact = spill_rows(E)
+
+    def nbytes(self):
+        # resident bytes held for search beyond a plain fp32 scan of E (none for fp32)
+        if self.En is None:
+            return 0
+        n = self.En.numel() * self.En.element_size()
+        if self.scales is not None:
+            n += self.scales.numel() * self.scales.element_size()
+        return n
+
+    def fp32_normalized_bytes(self):
+        # footprint of a full float32 normalized copy, the pre-streaming baseline
+        return self.V * self.D * 4
+
+    def block_similarities(self, v, start, end):
+        # cosine sims (rows x queries) of vocab rows [start, end) against normalized float32 queries v
+        if self.En is None:
+            blk = self.E[start:end].float()
+            return (blk @ v.T) / blk.norm(dim=1, keepdim=True).clamp_min(1e-8)
+        if self.scales is None:
+            return (self.En[start:end] @ v.to(self.En.dtype).T).float()
+        # int8: quantize the queries too, multiply with int32 accumulation, then rescale
+        vq, vs = quantize_rows(v)
+        sims = int8_matmul(self.En[start:end], vq.T.contiguous()).float()
+        return sims * self.scales[start:end].unsqueeze(1) * vs.unsqueeze(0)
+
+    def normalized_rows(self, start, end):
+        # float32 unit rows [start, end), read from the stored format when there is one
+        if self.En is None:
+            rows = self.E[start:end].float()
+            return rows / rows.norm(dim=1, keepdim=True).clamp_min(1e-8)
+        if self.scales is None:
+            return self.En[start:end].float()
+        return self.En[start:end].float() * self.scales[start:end].unsqueeze(1)
+
+    def exact_similarities(self, ids, v):
+        # float32 cosine sims for a subset of rows, used for re-ranking
+        if self.exact is None:
+            raise ValueError("store was built without exact rows (keep_exact=False)")
+        rows = self.exact[ids].float()
+        rows = rows / rows.norm(dim=1, keepdim=True).clamp_min(1e-8)
+        return (rows @ v.T).squeeze(1)
+
+
+def unit_mean(E, ids):
+    # normalized mean of the given embedding rows, as a 1 x D float32 query
+    v = E[ids].float().mean(dim=0, keepdim=True)
+    return v / v.norm(dim=1, keepdim=True).clamp_min(1e-8)
+
+
+def topk_scan(store, v, k, block_size=DEFAULT_BLOCK_SIZE, largest=True, mask=None, bias=None, exclude=None):
+    # streaming top-k over the vocab for each query row of v, merged block by block.
+    # rows where `mask` is False never make it into the result; `bias` is added
+    # to every row's score before ranking; exclude[r] is a vocab id dropped for
+    # query row r only (the query token itself).
+    worst = -1e9 if largest else 1e9
+    vals = torch.full((v.shape[0], 0), worst)
+    idx = torch.empty((v.shape[0], 0), dtype=torch.long)
+    nan_count = 0
+
+    for start in range(0, store.V, block_size):
+        end = min(start + block_size, store.V)
+        with PROFILER.phase("matmul"):
+            sims = store.block_similarities(v, start, end).T
+
+        with PROFILER.phase("topk"):
+            # NaN guard
+            nan_count += int(torch.isnan(sims).sum())
+            sims = torch.nan_to_num(sims, nan=worst, posinf=worst, neginf=worst)
+            if bias is not None:
+                sims = sims + bias[start:end]
+            if mask is not None:
+                sims[:, ~mask[start:end]] = worst
+            if exclude is not None:
+                hit = (exclude >= start) & (exclude < end)
+                sims[hit.nonzero().squeeze(1), exclude[hit] - start] = worst
+
+            ids = torch.arange(start, end).expand(v.shape[0], -1)
+            vals = torch.cat([vals, sims], dim=1)
+            idx = torch.cat([idx, ids], dim=1)
+            vals, pos = torch.topk(vals, k=min(k, vals.shape[1]), dim=1, largest=largest)
+            idx = torch.gather(idx, 1, pos)
+
+    return vals, idx, nan_count
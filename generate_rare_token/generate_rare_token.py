@@ -1,7 +1,25 @@
 import argparse
+import cProfile
+import gc
+import hashlib
+import json
+import os
 import re
+import sys
+from itertools import chain, islice
+from pathlib import Path
+
 import torch
-from transformers import Qwen2TokenizerFast, AutoModel
+
+# helpers shared by the embedding tools live in ../embedding_common
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "embedding_common"))
+from embedding_common import (  # noqa: E402
+    DEFAULT_BLOCK_SIZE,
+    PRECISIONS,
+    PROFILER,
+    EmbeddingStore,
+    topk_scan,
+)
 
 COMMON_STRINGS = [
     "the", "a", "an", "and", "of", "to", "in", "on", "for", "with", "at", "by", "from",
@@ -11,6 +29,8 @@ COMMON_STRINGS = [
     "i", "rt", "ing",
 ]
 
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "generate_rare_token"
+
 
 def typeable(s):
     if not s:
@@ -26,11 +46,112 @@ def typeable(s):
     return True
 
 
-def find_rare_tokens(tok, E, n=50):
-    # normalize safely
-    En = E / E.norm(dim=1, keepdim=True).clamp_min(1e-8)
+def candidate_mask(tok, V):
+    # typeable tokens that round-trip to a single token id
+    mask = torch.zeros(V, dtype=torch.bool)
+    for i in range(V):
+        s = tok.decode([i])
+        if not typeable(s):
+            continue
+        enc = tok.encode(s, add_special_tokens=False)
+        if len(enc) != 1 or enc[0] != i:
+            continue
+        mask[i] = True
+    return mask
+
+
+def corpus_files(paths, ext):
+    # (path, combined) pairs: caption files found in directories, combined caption files as given
+    files = []
+    for p in paths:
+        p = Path(p)
+        if p.is_dir():
+            files.extend((f, False) for f in sorted(p.iterdir()) if f.is_file() and f.suffix == ext)
+        elif p.is_file():
+            files.append((p, True))
+        else:
+            raise FileNotFoundError(f"corpus path does not exist: {p}")
+    return files
+
+
+def iter_corpus_texts(files):
+    for f, combined in files:
+        if not combined:
+            yield f.read_text(encoding="utf-8", errors="replace")
+            continue
+
+        # combined caption file: "[filename]: [prompt]" blocks separated by blank lines
+        with f.open(encoding="utf-8", errors="replace") as fh:
+            block = []
+            for line in chain(fh, [""]):
+                if line.strip():
+                    block.append(line.strip())
+                elif block:
+                    name, sep, prompt = " ".join(block).partition(":")
+                    yield prompt.strip() if sep else name
+                    block = []
+
+
+def batched(it, size):
+    it = iter(it)
+    while batch := list(islice(it, size)):
+        yield batch
+
+
+def corpus_cache_path(cache_dir, files, ext, tokenizer_id, V):
+    # keyed on tokenizer and on every corpus file's path, size and mtime
+    key = {
+        "tokenizer": tokenizer_id,
+        "vocab_size": V,
+        "extension": ext,
+        "files": [(str(f.resolve()), combined, f.stat().st_size, f.stat().st_mtime_ns) for f, combined in files],
+    }
+    digest = hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()[:24]
+    return Path(cache_dir) / f"freq_{digest}.pt"
+
+
+def token_frequencies(tok, files, V, batch_size=1024):
+    # stream corpus texts through the fast tokenizer in batches; encode_batch
+    # already spreads each batch across cores (Rayon), so it is called from one thread
+    backend = tok.backend_tokenizer
+    counts = torch.zeros(V, dtype=torch.long)
+
+    for batch in batched(iter_corpus_texts(files), batch_size):
+        encs = backend.encode_batch(batch, add_special_tokens=False)
+        ids = torch.tensor(list(chain.from_iterable(e.ids for e in encs)), dtype=torch.long)
+        counts += torch.bincount(ids, minlength=V)[:V]
+
+    return counts
+
 
-    # build common-token centroid
+def fold_space_prefixed(tok, counts, mask):
+    # mid-caption words are encoded with their leading space ("Ġ..." in byte-level
+    # BPE), so add each candidate's space-prefixed id count to its bare id
+    folded = counts.clone()
+    for i in mask.nonzero().squeeze(1).tolist():
+        enc = tok.encode(" " + tok.decode([i]), add_special_tokens=False)
+        if len(enc) == 1 and enc[0] != i:
+            folded[i] += counts[enc[0]]
+    return folded
+
+
+def load_token_frequencies(tok, paths, ext, V, tokenizer_id, cache_dir=DEFAULT_CACHE_DIR, batch_size=1024):
+    files = corpus_files(paths, ext)
+    cache = corpus_cache_path(cache_dir, files, ext, tokenizer_id, V)
+    if cache.exists():
+        print(f"corpus frequencies: cached {cache}", file=sys.stderr)
+        return torch.load(cache)
+
+    counts = token_frequencies(tok, files, V, batch_size=batch_size)
+    cache.parent.mkdir(parents=True, exist_ok=True)
+    torch.save(counts, cache)
+    print(f"corpus frequencies: {int(counts.sum())} tokens in {len(files)} file(s), cached {cache}",
+          file=sys.stderr)
+    return counts
+
+
+def common_centroid(tok, E):
+    # normalized mean of the normalized common-token rows, as a 1 x D float32 query
     common_ids = []
     for s in COMMON_STRINGS:
         ids = tok.encode(s, add_special_tokens=False)
@@ -38,27 +159,48 @@ def find_rare_tokens(tok, E, n=50):
             common_ids.append(ids[0])
     common_ids = list(dict.fromkeys(common_ids))  # unique
 
-    C = En[common_ids].mean(dim=0, keepdim=True)
+    C = E[common_ids].float()
     C = C / C.norm(dim=1, keepdim=True).clamp_min(1e-8)
+    C = C.mean(dim=0, keepdim=True)
+    return C / C.norm(dim=1, keepdim=True).clamp_min(1e-8)
 
-    # score tokens by distance from common centroid
-    sims = (En @ C.T).squeeze(1)
 
+def find_rare_tokens(tok, store, C, n=50, rerank=0, mask=None, block_size=DEFAULT_BLOCK_SIZE, bias=None):
     # filter to typeable single-token candidates
-    candidates = []
-    V = En.shape[0]
-    for i in range(V):
-        s = tok.decode([i])
-        if not typeable(s):
-            continue
-        enc = tok.encode(s, add_special_tokens=False)
-        if len(enc) != 1 or enc[0] != i:
-            continue
-        candidates.append((float(sims[i]), i, s))
+    if mask is None:
+        with PROFILER.phase("candidate filter"):
+            mask = candidate_mask(tok, store.V)
 
-    # lowest similarity to common centroid first
-    candidates.sort(key=lambda x: x[0])
-    return candidates[:n]
+    # lowest similarity to common centroid first, streamed over vocab blocks
+    vals, top, _ = topk_scan(store, C, max(n, rerank), block_size=block_size, largest=False, mask=mask,
+                             bias=bias)
+    vals, top = vals[0], top[0]
+    keep = mask[top]
+    vals, top = vals[keep], top[keep]
+
+    # optional exact float32 re-rank of the reduced-precision shortlist
+    if rerank and store.En is not None:
+        with PROFILER.phase("rerank"):
+            vals = store.exact_similarities(top, C)
+            if bias is not None:
+                vals = vals + bias[top]
+            vals, order = torch.sort(vals)
+            top = top[order]
+
+    with PROFILER.phase("decode"):
+        return [(s, i, tok.decode([i])) for s, i in zip(vals[:n].tolist(), top[:n].tolist())]
+
+
+def precision_report(store, source_bytes, n, candidates, baseline):
+    used = store.nbytes()
+    fp32_bytes = store.fp32_normalized_bytes()
+    overlap = len({i for _, i, _ in candidates} & {i for _, i, _ in baseline})
+    print("precision report:")
+    print(f"  normalized embeddings: {used / 2**20:.1f} MiB {store.precision} "
+          f"(fp32 normalized: {fp32_bytes / 2**20:.1f} MiB, saved {(fp32_bytes - used) / 2**20:.1f} MiB)")
+    if store.En is not None:
+        print(f"  embedding matrix: {source_bytes / 2**20:.1f} MiB, released once the store was built")
+    print(f"  top-{n} overlap with fp32: {overlap}/{len(baseline)}")
 
 
 def main():
@@ -73,15 +215,120 @@ def main():
                         help="Subfolder within `model` path to load the tokenizer from (default: tokenizer)")
     parser.add_argument("-n", type=int, default=50,
                         help="Number of rare tokens to return (default: 50)")
+    parser.add_argument("--precision", choices=list(PRECISIONS), default="fp32",
+                        help="Storage format of the normalized embeddings used for scoring (default: fp32)")
+    parser.add_argument("--rerank", type=int, default=0,
+                        help="Re-rank this many top candidates with exact float32 similarity (default: 0, off)")
+    parser.add_argument("--precision-report", action="store_true",
+                        help="Print memory saved and top-n overlap with the float32 baseline")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE,
+                        help=f"Vocab rows scanned per block (default: {DEFAULT_BLOCK_SIZE})")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Intra-op threads for torch (default: torch's own default)")
+    parser.add_argument("--corpus", action="append", default=[],
+                        help="Caption directory or combined caption file to count token frequencies in "
+                             "(repeatable)")
+    parser.add_argument("--corpus-extension", default=".caption",
+                        help="Caption file extension inside --corpus directories (default: .caption)")
+    parser.add_argument("--corpus-workers", type=int, default=None,
+                        help="Tokenizer threads for --corpus, via RAYON_NUM_THREADS (default: all cores)")
+    parser.add_argument("--corpus-batch-size", type=int, default=1024,
+                        help="Captions tokenized per batch (default: 1024)")
+    parser.add_argument("--corpus-cache-dir", default=str(DEFAULT_CACHE_DIR),
+                        help=f"Where corpus token frequencies are cached (default: {DEFAULT_CACHE_DIR})")
+    parser.add_argument("--max-count", type=int, default=0,
+                        help="Tokens occurring more than this many times in the corpus are filtered (default: 0)")
+    parser.add_argument("--frequency-mode", choices=["exclude", "downrank"], default="exclude",
+                        help="Drop tokens above --max-count, or push them down the ranking (default: exclude)")
+    parser.add_argument("--downrank-weight", type=float, default=0.05,
+                        help="Score penalty per log(1 + count) in downrank mode (default: 0.05)")
+    parser.add_argument("--profile", action="store_true",
+                        help="Print wall time, CPU time and peak RSS per phase to stderr")
+    parser.add_argument("--profile-json", metavar="PATH", default=None,
+                        help="Write per-phase totals and a chrome://tracing event trace to PATH (implies --profile)")
+    parser.add_argument("--profile-cprofile", metavar="PATH", default=None,
+                        help="Write a cProfile dump of the run to PATH (implies --profile)")
     args = parser.parse_args()
 
-    tok = Qwen2TokenizerFast.from_pretrained(args.model_tokenizer, subfolder=args.model_tokenizer_subfolder)
-    model = AutoModel.from_pretrained(args.model, trust_remote_code=True, device_map="cpu")
-    E = model.get_input_embeddings().weight.detach().float()
+    PROFILER.enabled = bool(args.profile or args.profile_json or args.profile_cprofile)
+    cprof = cProfile.Profile() if args.profile_cprofile else None
+    if cprof is not None:
+        cprof.enable()
+    try:
+        run(args)
+    finally:
+        if cprof is not None:
+            cprof.disable()
+            cprof.dump_stats(args.profile_cprofile)
+        if PROFILER.enabled:
+            PROFILER.summary()
+        if args.profile_json:
+            PROFILER.write_json(args.profile_json)
+
+
+def run(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.corpus_workers:
+        # the fast tokenizer's Rayon pool reads this on first use
+        os.environ["RAYON_NUM_THREADS"] = str(args.corpus_workers)
 
-    candidates = find_rare_tokens(tok, E, n=args.n)
+    with PROFILER.phase("import transformers"):
+        from transformers import Qwen2TokenizerFast, AutoModel
+
+    with PROFILER.phase("tokenizer load"):
+        tok = Qwen2TokenizerFast.from_pretrained(args.model_tokenizer, subfolder=args.model_tokenizer_subfolder)
+    with PROFILER.phase("model load"):
+        model = AutoModel.from_pretrained(args.model, trust_remote_code=True, device_map="cpu")
+        E = model.get_input_embeddings().weight.detach()
+        # only the embedding matrix is needed; free the rest of the model
+        del model
+        gc.collect()
+    V = E.shape[0]
+    C = common_centroid(tok, E)
+    with PROFILER.phase("candidate filter"):
+        mask = candidate_mask(tok, V)
+
+    # corpus-aware filtering: drop or penalize tokens already common in the captions
+    counts, bias = None, None
+    if args.corpus:
+        tokenizer_id = f"{args.model_tokenizer}/{args.model_tokenizer_subfolder}"
+        with PROFILER.phase("corpus frequencies"):
+            counts = load_token_frequencies(tok, args.corpus, args.corpus_extension, V, tokenizer_id,
+                                            cache_dir=args.corpus_cache_dir, batch_size=args.corpus_batch_size)
+            counts = fold_space_prefixed(tok, counts, mask)
+        frequent = counts > args.max_count
+        if args.frequency_mode == "exclude":
+            mask &= ~frequent
+        else:
+            bias = torch.where(frequent, args.downrank_weight * torch.log1p(counts.float()), torch.zeros(()))
+
+    # the float32 baseline needs the exact matrix, so run it before E is released
+    if args.precision_report:
+        with PROFILER.phase("precision baseline"):
+            baseline = find_rare_tokens(tok, EmbeddingStore(E), C, n=args.n, mask=mask,
+                                        block_size=args.block_size, bias=bias)
+
+    with PROFILER.phase("normalize"):
+        store = EmbeddingStore(E, args.precision, block_size=args.block_size, keep_exact=args.rerank > 0)
+        # reduced precisions no longer need E; fp32 scans it directly
+        source_bytes = E.numel() * E.element_size()
+        del E
+        gc.collect()
+
+    candidates = find_rare_tokens(tok, store, C, n=args.n, rerank=args.rerank, mask=mask,
+                                  block_size=args.block_size, bias=bias)
+    if bias is not None:
+        print("score = cosine similarity + downrank penalty")
     for sim, i, s in candidates:
-        print(f"{sim: .4f}  id={i:<6}  {repr(s)}")
+        if counts is not None:
+            print(f"{sim: .4f}  id={i:<6}  count={int(counts[i]):<6}  {repr(s)}")
+        else:
+            print(f"{sim: .4f}  id={i:<6}  {repr(s)}")
+
+    if args.precision_report:
+        with PROFILER.phase("precision report"):
+            precision_report(store, source_bytes, args.n, candidates, baseline)
 
 
 if __name__ == "__main__":
@@ -1,17 +1,136 @@
 import argparse
+import cProfile
+import gc
+import json
+import os
+import sys
+from pathlib import Path
+
 import torch
-from transformers import Qwen2TokenizerFast, AutoModel
 
+# helpers shared by the embedding tools live in ../embedding_common
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "embedding_common"))
+from embedding_common import (  # noqa: E402
+    DEFAULT_BLOCK_SIZE,
+    PRECISIONS,
+    PROFILER,
+    EmbeddingStore,
+    topk_scan,
+    unit_mean,
+)
+
+# query rows per tile in --all-pairs mode; a tile holds tile x block sims
+DEFAULT_TILE_SIZE = 1024
+
+# kNN graph layout: raw native-endian V x k tables plus a json header
+GRAPH_META = "meta.json"
+GRAPH_INDICES = "indices.i32"
+GRAPH_SCORES = "scores.f16"
+
+
+def nearest_tokens(tok, store, ids, v, k=20, rerank=0, block_size=DEFAULT_BLOCK_SIZE):
+    # streaming cosine top-k of query v over the store
+    vals, top, nan_count = topk_scan(store, v, max(k, rerank), block_size=block_size)
+    vals, top = vals[0], top[0]
+
+    # optional exact float32 re-rank of the reduced-precision shortlist
+    if rerank and store.En is not None:
+        with PROFILER.phase("rerank"):
+            vals = torch.nan_to_num(store.exact_similarities(top, v), nan=-1e9, posinf=-1e9, neginf=-1e9)
+            vals, order = torch.sort(vals, descending=True)
+            top = top[order]
+
+    top = top[:k].tolist()
+    with PROFILER.phase("decode"):
+        out = [(tok.decode([i]), float(s)) for i, s in zip(top, vals[:k].tolist())]
+
+    return [tok.decode([i]) for i in ids], out, nan_count, top
+
+
+def precision_report(store, source_bytes, k, top, baseline):
+    used = store.nbytes()
+    fp32_bytes = store.fp32_normalized_bytes()
+    overlap = len(set(top) & set(baseline))
+    print("precision report:")
+    print(f"  normalized embeddings: {used / 2**20:.1f} MiB {store.precision} "
+          f"(fp32 normalized: {fp32_bytes / 2**20:.1f} MiB, saved {(fp32_bytes - used) / 2**20:.1f} MiB)")
+    if store.En is not None:
+        print(f"  embedding matrix: {source_bytes / 2**20:.1f} MiB, released once the store was built")
+    print(f"  top-{k} overlap with fp32: {overlap}/{len(baseline)}")
+
+
+def open_graph_table(path, rows, k, dtype, create=False):
+    # memory-map a rows x k table; created tables are shared so writes land in the file
+    size = rows * k
+    if create:
+        with open(path, "ab") as f:
+            f.truncate(size * torch.empty((), dtype=dtype).element_size())
+    return torch.from_file(str(path), shared=create, size=size, dtype=dtype).view(rows, k)
+
+
+def write_graph_meta(out_dir, meta):
+    # write-then-rename so an interrupted run never leaves a torn header
+    tmp = out_dir / (GRAPH_META + ".tmp")
+    tmp.write_text(json.dumps(meta, indent=2), encoding="utf-8")
+    os.replace(tmp, out_dir / GRAPH_META)
+
+
+def all_pairs_knn(store, k, out_dir, block_size=DEFAULT_BLOCK_SIZE, tile_size=DEFAULT_TILE_SIZE, info=None):
+    # top-k neighbours of every vocab token, one query tile at a time against
+    # streamed vocab blocks, so the V x V matrix is never built
+    V = store.V
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    meta = {"vocab_size": V, "k": k, "indices_dtype": "int32", "scores_dtype": "float16", **(info or {})}
+    meta_path = out_dir / GRAPH_META
+    rows_done = 0
+    if meta_path.exists():
+        old = json.loads(meta_path.read_text(encoding="utf-8"))
+        if {key: old.get(key) for key in meta} == meta:
+            rows_done = old.get("rows_done", 0)
+            print(f"resuming at row {rows_done}/{V}", file=sys.stderr)
+    if rows_done == 0:
+        # header first, so a stale one never describes the resized tables below
+        write_graph_meta(out_dir, {**meta, "rows_done": 0})
+
+    indices = open_graph_table(out_dir / GRAPH_INDICES, V, k, torch.int32, create=True)
+    scores = open_graph_table(out_dir / GRAPH_SCORES, V, k, torch.float16, create=True)
+
+    for start in range(rows_done, V, tile_size):
+        end = min(start + tile_size, V)
+        q = store.normalized_rows(start, end)
+        vals, idx, _ = topk_scan(store, q, k, block_size=block_size, exclude=torch.arange(start, end))
+        indices[start:end] = idx.to(torch.int32)
+        scores[start:end] = vals.to(torch.float16)
+
+        # checkpoint after every tile
+        with PROFILER.phase("checkpoint"):
+            write_graph_meta(out_dir, {**meta, "rows_done": end})
+        print(f"rows {end}/{V}", file=sys.stderr)
 
-def nearest_tokens(tok, E, text, k=20):
+    return indices, scores
+
+
+def load_graph(graph_dir):
+    graph_dir = Path(graph_dir)
+    meta = json.loads((graph_dir / GRAPH_META).read_text(encoding="utf-8"))
+    V, k = meta["vocab_size"], meta["k"]
+    indices = open_graph_table(graph_dir / GRAPH_INDICES, V, k, torch.int32)
+    scores = open_graph_table(graph_dir / GRAPH_SCORES, V, k, torch.float16)
+    return meta, indices, scores
+
+
+def graph_neighbours(tok, graph_dir, text, k=None):
+    # look up precomputed neighbours of each subtoken of text
+    meta, indices, scores = load_graph(graph_dir)
     ids = tok.encode(text, add_special_tokens=False)
-    # average embedding across sub-tokens
-    v = E[ids].mean(dim=0, keepdim=True)
-    v = v / v.norm(dim=1, keepdim=True)
-    En = E / E.norm(dim=1, keepdim=True)
-    sims = (En @ v.T).squeeze(1)
-    top = torch.topk(sims, k=k).indices.tolist()
-    out = [(tok.decode([i]), float(sims[i])) for i in top]
+    out = []
+    for i in ids:
+        if i >= meta.get("rows_done", 0):
+            out.append((i, None))
+            continue
+        row = [(tok.decode([j]), float(s)) for j, s in zip(indices[i].tolist(), scores[i].tolist())]
+        out.append((i, row[:k]))
     return ids, [tok.decode([i]) for i in ids], out
 
 
@@ -19,7 +138,7 @@ def main():
     parser = argparse.ArgumentParser(
         description="Find tokens nearest to input text in embedding space using cosine similarity."
     )
-    parser.add_argument("text", help="Text to find nearest tokens for")
+    parser.add_argument("text", nargs="?", help="Text to find nearest tokens for")
     parser.add_argument("--model", default="Qwen/Qwen2.5-VL-7B-Instruct",
                         help="Pretrained model name or local path (default: Qwen/Qwen2.5-VL-7B-Instruct)")
     parser.add_argument("--model-tokenizer", default="Qwen/Qwen-Image",
@@ -27,13 +146,113 @@ def main():
     parser.add_argument("--model-tokenizer-subfolder", default="tokenizer",
                         help="Subfolder within `model` path to load the tokenizer from (default: tokenizer)")
     parser.add_argument("-k", type=int, default=20, help="Number of nearest tokens to return (default: 20)")
+    parser.add_argument("--precision", choices=list(PRECISIONS), default="fp32",
+                        help="Storage format of the normalized embeddings used for search (default: fp32)")
+    parser.add_argument("--rerank", type=int, default=0,
+                        help="Re-rank this many top candidates with exact float32 similarity (default: 0, off)")
+    parser.add_argument("--precision-report", action="store_true",
+                        help="Print memory saved and top-k overlap with the float32 baseline")
+    parser.add_argument("--block-size", type=int, default=DEFAULT_BLOCK_SIZE,
+                        help=f"Vocab rows scanned per block (default: {DEFAULT_BLOCK_SIZE})")
+    parser.add_argument("--threads", type=int, default=None,
+                        help="Intra-op threads for torch (default: torch's own default)")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--all-pairs", metavar="OUT_DIR", default=None,
+                      help="Compute the top-k neighbours of every vocab token and write a kNN graph to OUT_DIR")
+    mode.add_argument("--graph", metavar="GRAPH_DIR", default=None,
+                      help="Look up neighbours of the text's subtokens in a kNN graph written by --all-pairs")
+    parser.add_argument("--tile-size", type=int, default=DEFAULT_TILE_SIZE,
+                        help=f"Query rows per tile in --all-pairs mode (default: {DEFAULT_TILE_SIZE})")
+    parser.add_argument("--profile", action="store_true",
+                        help="Print wall time, CPU time and peak RSS per phase to stderr")
+    parser.add_argument("--profile-json", metavar="PATH", default=None,
+                        help="Write per-phase totals and a chrome://tracing event trace to PATH (implies --profile)")
+    parser.add_argument("--profile-cprofile", metavar="PATH", default=None,
+                        help="Write a cProfile dump of the run to PATH (implies --profile)")
     args = parser.parse_args()
 
-    tok = Qwen2TokenizerFast.from_pretrained(args.model_tokenizer, subfolder=args.model_tokenizer_subfolder, trust_remote_code=True)
-    model = AutoModel.from_pretrained(args.model, trust_remote_code=True)
-    E = model.get_input_embeddings().weight.detach().float()
+    if args.graph is not None and args.text is None:
+        parser.error("text is required with --graph")
+    if args.text is None and args.all_pairs is None:
+        parser.error("text is required unless --all-pairs is given")
+    if args.all_pairs is not None and args.text is not None:
+        parser.error("text cannot be used with --all-pairs")
+    # the graph is scored once in the chosen --precision; there is no per-query shortlist
+    for flag, value in (("--rerank", args.rerank), ("--precision-report", args.precision_report)):
+        if value and (args.all_pairs is not None or args.graph is not None):
+            parser.error(f"{flag} cannot be used with --all-pairs or --graph")
+
+    PROFILER.enabled = bool(args.profile or args.profile_json or args.profile_cprofile)
+    cprof = cProfile.Profile() if args.profile_cprofile else None
+    if cprof is not None:
+        cprof.enable()
+    try:
+        run(args)
+    finally:
+        if cprof is not None:
+            cprof.disable()
+            cprof.dump_stats(args.profile_cprofile)
+        if PROFILER.enabled:
+            PROFILER.summary()
+        if args.profile_json:
+            PROFILER.write_json(args.profile_json)
+
+
+def run(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+
+    with PROFILER.phase("import transformers"):
+        from transformers import Qwen2TokenizerFast, AutoModel
+
+    with PROFILER.phase("tokenizer load"):
+        tok = Qwen2TokenizerFast.from_pretrained(args.model_tokenizer, subfolder=args.model_tokenizer_subfolder, trust_remote_code=True)
+
+    if args.graph:
+        with PROFILER.phase("graph lookup"):
+            ids, toks, rows = graph_neighbours(tok, args.graph, args.text, k=args.k)
+        print("ids:", ids)
+        print("subtokens:", toks)
+        for (i, row), t in zip(rows, toks):
+            if row is None:
+                print(f"neighbours of {repr(t)} (id={i}): not in graph")
+                continue
+            print(f"neighbours of {repr(t)} (id={i}):")
+            for n, s in row:
+                print(f"{s: .4f}  {repr(n)}")
+        return
 
-    ids, toks, nn, nan_count = nearest_tokens(tok, E, args.text, k=args.k)
+    with PROFILER.phase("model load"):
+        model = AutoModel.from_pretrained(args.model, trust_remote_code=True)
+        E = model.get_input_embeddings().weight.detach()
+        # only the embedding matrix is needed; free the rest of the model
+        del model
+        gc.collect()
+
+    # everything that needs the exact matrix happens before it is released
+    if args.text is not None:
+        ids = tok.encode(args.text, add_special_tokens=False)
+        v = unit_mean(E, ids)
+    if args.precision_report:
+        with PROFILER.phase("precision baseline"):
+            _, baseline, _ = topk_scan(EmbeddingStore(E), v, args.k, block_size=args.block_size)
+            baseline = baseline[0].tolist()
+
+    with PROFILER.phase("normalize"):
+        store = EmbeddingStore(E, args.precision, block_size=args.block_size, keep_exact=args.rerank > 0)
+        # reduced precisions no longer need E; fp32 scans it directly
+        source_bytes = E.numel() * E.element_size()
+        del E
+        gc.collect()
+
+    if args.all_pairs:
+        info = {"model": args.model, "precision": args.precision}
+        all_pairs_knn(store, args.k, Path(args.all_pairs), block_size=args.block_size,
+                      tile_size=args.tile_size, info=info)
+        return
+
+    toks, nn, nan_count, top = nearest_tokens(tok, store, ids, v, k=args.k, rerank=args.rerank,
+                                              block_size=args.block_size)
     print("ids:", ids)
     print("subtokens:", toks)
     print("nan sims:", nan_count)
@@ -41,27 +260,10 @@ def main():
     for t, s in nn:
         print(f"{s: .4f}  {repr(t)}")
 
-def nearest_tokens(tok, E, text, k=20):
-    # tokenize
-    ids = tok.encode(text, add_special_tokens=False)
-
-    # pre-normalize vocab embeddings safely
-    Enorm = E.norm(dim=1, keepdim=True).clamp_min(1e-8)
-    En = E / Enorm
-
-    # build query vector from subtoken embeddings
-    v = E[ids].mean(dim=0, keepdim=True)
-    v = v / v.norm(dim=1, keepdim=True).clamp_min(1e-8)
-
-    # cosine sims + NaN guard
-    sims = (En @ v.T).squeeze(1)
-    sims = torch.nan_to_num(sims, nan=-1e9, posinf=-1e9, neginf=-1e9)
-
-    top = torch.topk(sims, k=k).indices.tolist()
-    out = [(tok.decode([i]), float(sims[i])) for i in top]
-
-    return ids, [tok.decode([i]) for i in ids], out, int(torch.isnan(sims).sum())
+    if args.precision_report:
+        with PROFILER.phase("precision report"):
+            precision_report(store, source_bytes, args.k, top, baseline)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()